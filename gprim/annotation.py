@@ -1,8 +1,30 @@
 from __future__ import print_function, division
-import os, gzip
+import os
+# isal's igzip is a drop-in gzip replacement that decompresses 2-3x faster
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+try:
+    from isal import isal_zlib as zlib
+except ImportError:
+    import zlib
+# arrow's csv reader parses in parallel and converts to pandas zero-copy
+try:
+    import pyarrow.csv as pacsv
+except ImportError:
+    pacsv = None
+# numba compiles the per-snp reconcile loop to parallel machine code when it
+# is available; the vectorized numpy path remains as the fallback
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 import numpy as np
 import pandas as pd
 import itertools
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from ypy import memo, fs
 
 
@@ -10,16 +32,16 @@ from ypy import memo, fs
 COMPLEMENT = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
 # bases
 BASES = COMPLEMENT.keys()
-# true iff strand ambiguous
-STRAND_AMBIGUOUS = {''.join(x): x[0] == COMPLEMENT[x[1]]
+# strand ambiguous pairs of alleles
+STRAND_AMBIGUOUS = frozenset(''.join(x)
         for x in itertools.product(BASES, BASES)
-        if x[0] != x[1]}
+        if x[0] != x[1] and x[0] == COMPLEMENT[x[1]])
 # SNPS we want to keep (pairs of alleles)
-VALID_SNPS = {x for x in map(lambda y: ''.join(y), itertools.product(BASES, BASES))
-        if x[0] != x[1] and not STRAND_AMBIGUOUS[x]}
+VALID_SNPS = frozenset(x for x in map(lambda y: ''.join(y), itertools.product(BASES, BASES))
+        if x[0] != x[1] and x not in STRAND_AMBIGUOUS)
 # T iff SNP 1 has the same alleles as SNP 2 (allowing for strand or ref allele flip)
 # and neither is invalid.
-MATCH_ALLELES = {
+MATCH_ALLELES = frozenset(
         x for x in map(lambda y: ''.join(y), itertools.product(VALID_SNPS, VALID_SNPS))
         # strand and ref match
         if ((x[0] == x[2]) and (x[1] == x[3])) or
@@ -28,13 +50,90 @@ MATCH_ALLELES = {
         # ref flip, strand match
         ((x[0] == x[3]) and (x[1] == x[2])) or
         # ref flip, strand flip
-        ((x[0] == COMPLEMENT[x[3]]) and (x[1] == COMPLEMENT[x[2]]))}
+        ((x[0] == COMPLEMENT[x[3]]) and (x[1] == COMPLEMENT[x[2]])))
 # T iff SNP 1 has the same alleles as SNP 2 w/ ref allele flip and neither is invalid
-FLIP_ALLELES = {x for x in MATCH_ALLELES
+FLIP_ALLELES = frozenset(x for x in MATCH_ALLELES
         # ref flip, strand match
         if ((x[0] == x[3]) and (x[1] == x[2])) or
         # ref flip, strand flip
-        ((x[0] == COMPLEMENT[x[3]]) and (x[1] == COMPLEMENT[x[2]]))}
+        ((x[0] == COMPLEMENT[x[3]]) and (x[1] == COMPLEMENT[x[2]])))
+
+# columns holding snp metadata rather than annotation values
+SNP_META_COLS = ['SNP','CHR','CM','BP','A1','A2']
+
+# 2-bit codes for the bases, so that a set of four alleles fits in one byte
+CODES = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+# ascii byte -> 2-bit base code; non-ACGT bytes get 4 so they're detectable.
+# both cases map to the same code, so no upper() pass over the alleles is needed
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for b, c in CODES.items():
+    BASE_CODES[ord(b)] = BASE_CODES[ord(b.lower())] = c
+# 256-entry lookup tables indexed by the packed codes of A1+A2+A1_df+A2_df,
+# so that match/flip become one vectorized fancy-indexing pass rather than a
+# python-level set probe per snp
+MATCH_LUT = np.zeros(256, dtype=bool)
+FLIP_LUT = np.zeros(256, dtype=bool)
+for x in MATCH_ALLELES:
+    packed = (CODES[x[0]] << 6) | (CODES[x[1]] << 4) | (CODES[x[2]] << 2) | CODES[x[3]]
+    MATCH_LUT[packed] = True
+    FLIP_LUT[packed] = x in FLIP_ALLELES
+
+# alleles stored as int8 categorical codes rather than per-row python strings;
+# '-' is the placeholder reconciled_to uses for snps that are missing from df
+ALLELE_DTYPE = pd.CategoricalDtype(['A','C','G','T','-'])
+
+# compresses the A1/A2 columns of df to ALLELE_DTYPE, leaving columns that
+# carry indels or other nonstandard alleles as strings
+def compress_alleles(df):
+    for c in ('A1', 'A2'):
+        if c in df.columns:
+            vals = df[c].astype(ALLELE_DTYPE)
+            if not (vals.isnull() & df[c].notnull()).any():
+                df[c] = vals
+    return df
+
+# maps a Series of allele strings to 2-bit base codes; anything other than a
+# single A/C/G/T (e.g. indels) gets the invalid code 4
+def allele_codes(s):
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        # code the (few) categories, then spread them through the int8 codes
+        catcodes = allele_codes(s.cat.categories.to_series())
+        codes = s.cat.codes.values
+        result = np.full(len(s), 4, dtype=np.uint8)
+        present = codes >= 0
+        result[present] = catcodes[codes[present]]
+        return result
+    raw = np.frombuffer(s.values.astype('S2').tobytes(), dtype=np.uint8).reshape(-1, 2)
+    codes = BASE_CODES[raw[:,0]].copy()
+    codes[raw[:,1] != 0] = 4
+    return codes
+
+
+# reads a gzipped tab-separated file, mirroring it to a feather file alongside
+# the original so that repeat reads skip the gzip+parse work entirely
+def read_tsv_mirrored(fname):
+    cache = fname + '.feather'
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(fname):
+        try:
+            return pd.read_feather(cache)
+        except Exception as e:
+            print('NOTE: ignoring unreadable feather mirror', cache, ':', e)
+    with (gzip.open(fname, 'rb') if fname.endswith('.gz')
+            else open(fname, 'rb')) as f:
+        if pacsv is not None:
+            df = pacsv.read_csv(f,
+                    parse_options=pacsv.ParseOptions(delimiter='\t')).to_pandas(
+                    self_destruct=True, split_blocks=True)
+        else:
+            df = pd.read_csv(f, header=0, sep='\t')
+    # write through a temp file so a crash mid-write can't leave a fresh-
+    # looking corrupt mirror behind
+    try:
+        df.to_feather(cache + '.tmp')
+        os.replace(cache + '.tmp', cache)
+    except Exception as e:
+        print('NOTE: could not write feather mirror', cache, ':', e)
+    return df
 
 
 # Checks if SNP columns are equal. If so, save time by using concat instead of merge.
@@ -49,12 +148,19 @@ def smart_merge(x, y=[], how='inner', fail_if_nonmatching=False, drop_from_y=[],
         y = x[1:] + y
         x = x[0]
 
-    # drop uninteresting columns from y and check that snps match
+    # select away uninteresting columns from y (without mutating the callers'
+    # dataframes) and check that snps match
+    if drop_from_y:
+        y = [d[[c for c in d.columns if c not in drop_from_y]] for d in y]
     matching = True
     for d in y:
-        d.drop(drop_from_y, axis=1, inplace=True)
-        if len(x) != len(d) or (x[key].values != d[key].values).any():
+        if len(x) != len(d):
             matching = False
+            break
+        xv, dv = x[key].values, d[key].values
+        if xv is not dv and not np.array_equal(xv, dv):
+            matching = False
+            break
 
     x = x.reset_index(drop=True)
     if matching:
@@ -70,55 +176,120 @@ def smart_merge(x, y=[], how='inner', fail_if_nonmatching=False, drop_from_y=[],
                         d.reset_index(drop=True), how=how, on=key)
         return x
 
+# reconciled_to results keyed by the identity of the input frames, bounded so
+# long pipelines don't hold every result alive. each entry carries weakrefs to
+# the frames it was computed from, and a hit requires those weakrefs to still
+# point at the very frames passed in -- so a recycled id() can never alias a
+# dead frame. the common beneficiaries are the long-lived memoized frames
+# handed out by Annotation/Dataset
+RECONCILE_CACHE_SIZE = 64
+_reconcile_cache = {}
+
+if njit is not None:
+    # packs the four base codes per snp, probes the match/flip luts, and
+    # rewrites the annotation block, all in one parallel pass over the rows
+    @njit(parallel=True, cache=True)
+    def _reconcile_kernel(c1, c2, c3, c4, missing, match_lut, flip_lut,
+            block, missing_val, signed):
+        n = c1.shape[0]
+        match = np.zeros(n, dtype=np.bool_)
+        flip = np.zeros(n, dtype=np.bool_)
+        for i in prange(n):
+            if not missing[i] and c1[i] < 4 and c2[i] < 4 and c3[i] < 4 \
+                    and c4[i] < 4:
+                p = (c1[i] << 6) | (c2[i] << 4) | (c3[i] << 2) | c4[i]
+                if match_lut[p]:
+                    match[i] = True
+                    flip[i] = flip_lut[p]
+            if not match[i]:
+                for k in range(block.shape[1]):
+                    block[i, k] = missing_val
+            elif signed and flip[i]:
+                for k in range(block.shape[1]):
+                    block[i, k] = -block[i, k]
+        return match, flip
+
 # keeps only snps in ref, flips alleles in df to match those in ref, and sets value at
-# non-matching snps to a missing_val (0 by default). 
+# non-matching snps to a missing_val (0 by default).
 # ref must contain: SNP, A1, A2
 # df must contain: SNP, A1, A2, and colnames
 def reconciled_to(ref, df, colnames, othercolnames=[], signed=True, missing_val=0, key='SNP'):
-    result = smart_merge(
-        ref,
-        df[[key,'A1','A2']+list(colnames)+othercolnames].rename(
-            columns={'A1':'A1_df','A2':'A2_df'}),
-        how='left',
-        key=key)
+    cachekey = (id(ref), id(df), tuple(colnames), tuple(othercolnames),
+            signed, missing_val, key)
+    entry = _reconcile_cache.get(cachekey)
+    if entry is not None:
+        ref_wr, df_wr, cached = entry
+        if ref_wr() is ref and df_wr() is df:
+            return cached
+        del _reconcile_cache[cachekey]
+    dfx = df[[key,'A1','A2']+list(colnames)+othercolnames].rename(
+            columns={'A1':'A1_df','A2':'A2_df'})
+    if not dfx[key].duplicated().values.any():
+        # with unique df snps a left merge is just a reindex: one hash table
+        # built on df, one probe per ref snp, and no result permutation
+        lookup = dfx.set_index(key).reindex(ref[key].values)
+        result = pd.concat(
+                [ref.reset_index(drop=True), lookup.reset_index(drop=True)], axis=1)
+    else:
+        result = smart_merge(ref, dfx, how='left', key=key)
     print(len(result), 'snps after merging')
     if len(result) != len(ref):
         print('WARNING: merged data frame is not the same length as reference data frame')
         print('   check for duplicate snps in one of the two dataframes')
 
-    # snps in ref but not in df
+    # resolve the annotation columns to integer positions once and do all the
+    # numeric writes on the underlying array, avoiding pandas label-based
+    # indexing (which copies the block on every boolean assignment)
+    col_idx = [result.columns.get_loc(c) for c in colnames]
+    block = result.iloc[:,col_idx].to_numpy(copy=True)
+
+    # snps in ref but not in df; they get missing_val below along with the
+    # mismatches, since missing snps can never match
     missing = result.A1_df.isnull()
     print('of', len(result), 'snps in merge,', missing.sum(), 'were missing in df')
-    result.loc[missing,colnames] = missing_val
     result.loc[missing,'A1_df'] = result.loc[missing,'A2_df'] = '-'
 
     # snps in both, but either invalid or not matching
-    a1234 = (result.A1+result.A2+result.A1_df+result.A2_df).apply(lambda y: y.upper())
-    match = ~missing & a1234.apply(lambda y: y in MATCH_ALLELES)
-    n_mismatch = (~missing & ~match).sum()
+    c1 = allele_codes(result.A1)
+    c2 = allele_codes(result.A2)
+    c3 = allele_codes(result.A1_df)
+    c4 = allele_codes(result.A2_df)
+    if njit is not None:
+        match, flip = _reconcile_kernel(c1, c2, c3, c4, missing.values,
+                MATCH_LUT, FLIP_LUT, block, missing_val, signed)
+    else:
+        valid = (c1 < 4) & (c2 < 4) & (c3 < 4) & (c4 < 4)
+        packed = (c1 << 6) | (c2 << 4) | (c3 << 2) | c4
+        match = ~missing.values & valid & MATCH_LUT[packed]
+        flip = match & FLIP_LUT[packed]
+        block[~match] = missing_val
+        if signed:
+            block[flip] *= -1
+    n_mismatch = (~missing.values & ~match).sum()
     print('of', (~missing).sum(), 'remaining snps,', n_mismatch,
             'are a) present in ref and df, b) do not have matching sets of alleles '+\
                     'that are both valid,')
-    result.loc[~missing & ~match,colnames] = missing_val
+    if signed:
+        print('of the remaining', match.sum(), 'snps,', flip.sum(), 'snps need flipping',
+            'and', (match & ~flip).sum(), 'snps matched and did not need flipping')
+    result.iloc[:,col_idx] = block
 
     # filter out SNPs with two sets of alleles in df by removing the version whose
     # alleles do not match those in ref
     counts = result.SNP.value_counts()
     dupsnps = counts.index[counts.values > 1]
+    bad = np.zeros(len(result), dtype=bool)
     for snp in dupsnps:
         print('removing instances of duplicate snp', snp,
             'where alleles do not match reference')
-        dropind = np.where(~match & (result.SNP == snp))[0]
-        result.drop(result.index[dropind], inplace=True)
-
-    if signed:
-        flip = match & a1234.apply(lambda y: y in FLIP_ALLELES)
-        n_flip = flip.sum()
-        print('of the remaining', match.sum(), 'snps,', n_flip, 'snps need flipping',
-            'and', (match & ~flip).sum(), 'snps matched and did not need flipping')
-        result.loc[flip,colnames] *= -1
+        bad |= ~match & (result.SNP == snp).values
+    result.drop(result.index[np.where(bad)[0]], inplace=True)
 
-    return result.drop(['A1_df', 'A2_df'], axis=1)
+    result = result.drop(['A1_df', 'A2_df'], axis=1)
+    while len(_reconcile_cache) >= RECONCILE_CACHE_SIZE:
+        _reconcile_cache.pop(next(iter(_reconcile_cache)))
+    _reconcile_cache[cachekey] = (weakref.ref(ref), weakref.ref(df), result)
+    return result
 
 # intersects bed file with a set of SNPs
 # bed - a BedTool containing a set of genomic intervals
@@ -149,6 +320,9 @@ class Annotation(object):
     def __init__(self, stem_chr, signed=True):
         self.stem_chr = stem_chr
         self.signed = signed
+        # annotation names by (chrnum, RV), filled in by whichever of names()
+        # or the full-frame loaders gets there first
+        self._names = {}
 
     def filestem(self, chrnum='', mkdir=False):
         fname = '{}{}'.format(self.stem_chr, chrnum)
@@ -168,31 +342,101 @@ class Annotation(object):
 
     def info_df(self, chrs=range(1,23)):
         if type(chrs) == int:
-            return pd.read_csv(self.info_filename(chrs), sep='\t', index_col=0)
+            fname = self.info_filename(chrs)
+            # these are tiny fixed-shape numeric tables; a .npy mirror loads
+            # with a single mmap instead of a csv parse
+            cache = fname + '.npy'
+            if os.path.exists(cache) and \
+                    os.path.getmtime(cache) >= os.path.getmtime(fname):
+                try:
+                    rec = np.load(cache, allow_pickle=True)
+                    return pd.DataFrame.from_records(rec, index=rec.dtype.names[0])
+                except Exception as e:
+                    print('NOTE: ignoring unreadable npy mirror', cache, ':', e)
+            df = pd.read_csv(fname, sep='\t', index_col=0)
+            try:
+                with open(cache + '.tmp', 'wb') as f:
+                    np.save(f, df.to_records(index=True))
+                os.replace(cache + '.tmp', cache)
+            except Exception as e:
+                print('NOTE: could not write npy mirror', cache, ':', e)
+            return df
         else:
-            return reduce(lambda x,y:x+y,
-                    [self.info_df(c) for c in chrs])
+            # the per-chromosome reads are I/O-bound and release the GIL, so
+            # overlap them with a thread pool; accumulate into one frame so
+            # peak memory stays a couple of chromosomes' worth
+            chrs = list(chrs)
+            with ThreadPoolExecutor(max_workers=min(len(chrs), 8)) as ex:
+                total = None
+                for df in ex.map(self.info_df, chrs):
+                    if total is None:
+                        total = df.copy()
+                    else:
+                        total += df
+            return total
     @memo.memoized
     def annot_df(self, chrnum):
-        df = pd.read_csv(self.annot_filename(chrnum),
-                compression='gzip', header=0, sep='\t')
+        df = compress_alleles(read_tsv_mirrored(self.annot_filename(chrnum)))
         return df.astype(dtype={n:float for n in self.names(chrnum)})
     @memo.memoized
     def sannot_df(self, chrnum):
-        df = pd.read_csv(self.sannot_filename(chrnum),
-                compression='gzip', header=0, sep='\t')
+        df = compress_alleles(read_tsv_mirrored(self.sannot_filename(chrnum)))
+        self._names.setdefault((chrnum, False),
+                [x for x in df.columns.values if not(x in SNP_META_COLS)])
         return df.astype(dtype={n:float for n in self.names(chrnum)})
     @memo.memoized
     def RV_df(self, chrnum):
-        return pd.read_csv(self.RV_filename(chrnum), sep='\t')
+        df = read_tsv_mirrored(self.RV_filename(chrnum))
+        self._names.setdefault((chrnum, True),
+                [x for x in df.columns.values if not(x in SNP_META_COLS)])
+        return df
 
     def names(self, chrnum, RV=False):
+        # if a full frame has already been loaded (or the names computed
+        # once), answer from memory without touching the filesystem
+        if (chrnum, RV) in self._names:
+            return self._names[(chrnum, RV)]
         if RV:
             fname = self.RV_filename(chrnum)
         else:
             fname = self.sannot_filename(chrnum)
-        temp = pd.read_csv(fname, nrows=1, delim_whitespace=True)
-        return [x for x in temp.columns.values if not(x in ['SNP','CHR','CM','BP','A1','A2'])]
+        # a tiny sidecar written after the first read means subsequent calls
+        # never have to decompress the gzip just to see the header
+        sidecar = fname + '.names.txt'
+        if os.path.exists(sidecar) and \
+                os.path.getmtime(sidecar) >= os.path.getmtime(fname):
+            with open(sidecar) as f:
+                result = [x for x in f.read().split('\t') if x]
+            self._names[(chrnum, RV)] = result
+            return result
+        # decompress just enough of the stream to recover the header line,
+        # skipping gzip file-object and csv-parser setup entirely
+        head = b''
+        with open(fname, 'rb') as f:
+            dec = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            while b'\n' not in head:
+                raw = f.read(8192)
+                if not raw:
+                    break
+                # walk gzip member boundaries so multi-member files (e.g.
+                # bgzip output) with long headers decode correctly
+                while raw:
+                    head += dec.decompress(raw)
+                    if dec.eof:
+                        raw = dec.unused_data
+                        dec = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                    else:
+                        raw = b''
+        result = [x for x in head.split(b'\n')[0].decode().split()
+                if not(x in SNP_META_COLS)]
+        try:
+            with open(sidecar + '.tmp', 'w') as f:
+                f.write('\t'.join(result))
+            os.replace(sidecar + '.tmp', sidecar)
+        except Exception as e:
+            print('NOTE: could not write names sidecar', sidecar, ':', e)
+        self._names[(chrnum, RV)] = result
+        return result
 
     def total_sqnorms(self, chrs):
         return self.info_df(chrs)['sqnorm'].values
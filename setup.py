@@ -8,5 +8,5 @@ setup(name='gprim',
     author_email='yakir@seas.harvard.edu',
     license='MIT',
     packages=['gprim'],
-    install_requires=['pysnptools','pybedtools','ypy'],
+    install_requires=['pysnptools','pybedtools','ypy','pyarrow','python-isal'],
     zip_safe=False)